@@ -1,11 +1,12 @@
-import contextlib
+import itertools
 import os
 import re
 import shutil
 import subprocess
-import tarfile
+import zipfile
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, List, Tuple
+from typing import Any, Iterator, List, Tuple
 
 import allure  # type: ignore
 from fixtures.log_helper import log
@@ -33,21 +34,21 @@ def subprocess_capture(capture_dir: str, cmd: List[str], **kwargs: Any) -> str:
     stdout_filename = basepath + ".stdout"
     stderr_filename = basepath + ".stderr"
 
-    try:
-        with open(stdout_filename, "w") as stdout_f:
-            with open(stderr_filename, "w") as stderr_f:
-                log.info(f'Capturing stdout to "{base}.stdout" and stderr to "{base}.stderr"')
-                subprocess.run(cmd, **kwargs, stdout=stdout_f, stderr=stderr_f)
-    finally:
-        # Remove empty files if there is no output
-        for filename in (stdout_filename, stderr_filename):
-            if os.stat(filename).st_size == 0:
-                os.remove(filename)
+    with open(stdout_filename, "wb") as stdout_f, open(stderr_filename, "wb") as stderr_f:
+        log.info(f'Capturing stdout to "{base}.stdout" and stderr to "{base}.stderr"')
+        try:
+            subprocess.run(cmd, **kwargs, stdout=stdout_f, stderr=stderr_f)
+        finally:
+            # Remove empty files if there is no output. The child process
+            # shares our file offsets, so tell() is the amount it has written.
+            for f in (stdout_f, stderr_f):
+                if f.tell() == 0:
+                    os.remove(f.name)
 
     return basepath
 
 
-_global_counter = 0
+_global_counter = itertools.count(1)
 
 
 def global_counter() -> int:
@@ -56,21 +57,32 @@ def global_counter() -> int:
     This is useful for giving output files a unique number, so if we run the
     same command multiple times we can keep their output separate.
     """
-    global _global_counter
-    _global_counter += 1
-    return _global_counter
+    return next(_global_counter)
+
+
+_GC_RESULT_FIELDS = (
+    "layers_total",
+    "layers_needed_by_cutoff",
+    "layers_needed_by_pitr",
+    "layers_needed_by_branches",
+    "layers_not_updated",
+    "layers_removed",
+)
+
+
+_GC_DURATION_MSG = "GC duration %s ms"
+_GC_LAYERS_MSG = (
+    "  total: %s, needed_by_cutoff %s, needed_by_pitr %s"
+    " needed_by_branches: %s, not_updated: %s, removed: %s"
+)
 
 
 def print_gc_result(row):
-    log.info("GC duration {elapsed} ms".format_map(row))
-    log.info(
-        "  total: {layers_total}, needed_by_cutoff {layers_needed_by_cutoff}, needed_by_pitr {layers_needed_by_pitr}"
-        " needed_by_branches: {layers_needed_by_branches}, not_updated: {layers_not_updated}, removed: {layers_removed}".format_map(
-            row
-        )
-    )
+    log.info(_GC_DURATION_MSG, row["elapsed"])
+    log.info(_GC_LAYERS_MSG, *(row[field] for field in _GC_RESULT_FIELDS))
 
 
+@lru_cache(maxsize=1)
 def etcd_path() -> Path:
     path_output = shutil.which("etcd")
     if path_output is None:
@@ -88,61 +100,65 @@ def query_scalar(cur: cursor, query: str) -> Any:
     check mypy says that Optional is not indexable.
     """
     cur.execute(query)
-    var = cur.fetchone()
-    assert var is not None
-    return var[0]
+    row = cur.fetchone()
+    assert row is not None
+    (var,) = row
+    return var
 
 
 # Traverse directory to get total size.
 def get_dir_size(path: str) -> int:
     """Return size in bytes."""
     totalbytes = 0
-    for root, dirs, files in os.walk(path):
-        for name in files:
-            try:
-                totalbytes += os.path.getsize(os.path.join(root, name))
-            except FileNotFoundError:
-                pass  # file could be concurrently removed
+    stack = [path]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue  # like os.walk, skip directories that can't be listed
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        totalbytes += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    pass  # file could be concurrently removed
 
     return totalbytes
 
 
+# Matches both image ("KEY_START-KEY_END__LSN") and delta
+# ("KEY_START-KEY_END__LSN_START-LSN_END") layer file names.
+_LAYER_RE = re.compile(r"([0-9A-Fa-f]+)-([0-9A-Fa-f]+)__([0-9A-Fa-f]+)(?:-([0-9A-Fa-f]+))?")
+
+
 def get_timeline_dir_size(path: Path) -> int:
     """Get the timeline directory's total size, which only counts the layer files' size."""
     sz = 0
     for dir_entry in path.iterdir():
-        with contextlib.suppress(Exception):
-            # file is an image layer
-            _ = parse_image_layer(dir_entry.name)
-            sz += dir_entry.stat().st_size
-            continue
-
-        with contextlib.suppress(Exception):
-            # file is a delta layer
-            _ = parse_delta_layer(dir_entry.name)
+        if _LAYER_RE.fullmatch(dir_entry.name):
             sz += dir_entry.stat().st_size
-            continue
     return sz
 
 
 def parse_image_layer(f_name: str) -> Tuple[int, int, int]:
     """Parse an image layer file name. Return key start, key end, and snapshot lsn"""
-    parts = f_name.split("__")
-    key_parts = parts[0].split("-")
-    return int(key_parts[0], 16), int(key_parts[1], 16), int(parts[1], 16)
+    m = _LAYER_RE.fullmatch(f_name)
+    if m is None or m[4] is not None:
+        raise ValueError(f"not an image layer file name: {f_name}")
+    key_start, key_end, lsn, _ = m.groups()
+    return int(key_start, 16), int(key_end, 16), int(lsn, 16)
 
 
 def parse_delta_layer(f_name: str) -> Tuple[int, int, int, int]:
     """Parse a delta layer file name. Return key start, key end, lsn start, and lsn end"""
-    parts = f_name.split("__")
-    key_parts = parts[0].split("-")
-    lsn_parts = parts[1].split("-")
-    return (
-        int(key_parts[0], 16),
-        int(key_parts[1], 16),
-        int(lsn_parts[0], 16),
-        int(lsn_parts[1], 16),
-    )
+    m = _LAYER_RE.fullmatch(f_name)
+    if m is None or m[4] is None:
+        raise ValueError(f"not a delta layer file name: {f_name}")
+    key_start, key_end, lsn_start, lsn_end = m.groups()
+    return int(key_start, 16), int(key_end, 16), int(lsn_start, 16), int(lsn_end, 16)
 
 
 def get_scale_for_db(size_mb: int) -> int:
@@ -154,37 +170,70 @@ def get_scale_for_db(size_mb: int) -> int:
     return round(0.06689 * size_mb - 0.5)
 
 
-ATTACHMENT_NAME_REGEX = re.compile(
-    r".+\.log|.+\.stderr|.+\.stdout|.+\.filediff|.+\.metrics|flamegraph\.svg|regression\.diffs|.+\.html"
-)
+# Both are lowercase, file names are casefolded before matching against them
+ATTACHMENT_SUFFIXES = (".log", ".stderr", ".stdout", ".filediff", ".metrics", ".html")
+ATTACHMENT_NAMES = ("flamegraph.svg", "regression.diffs")
+
+
+def is_attachment_name(name: str) -> bool:
+    """Check if a file name matches `ATTACHMENT_SUFFIXES` or `ATTACHMENT_NAMES`, ignoring case"""
+    name = name.casefold()
+    return name in ATTACHMENT_NAMES or (
+        name.endswith(ATTACHMENT_SUFFIXES) and name not in ATTACHMENT_SUFFIXES
+    )
+
+
+def _iter_files(root: str) -> Iterator[os.DirEntry[str]]:
+    """Recursively yield entries for regular files in `root`, symlinks are not followed"""
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except (FileNotFoundError, PermissionError):
+            continue  # directory could be concurrently removed or be unreadable
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
 
 
 def allure_attach_from_dir(dir: Path):
-    """Attach all non-empty files from `dir` that matches `ATTACHMENT_NAME_REGEX` to Allure report"""
-
-    for attachment in Path(dir).glob("**/*"):
-        if ATTACHMENT_NAME_REGEX.fullmatch(attachment.name) and attachment.stat().st_size > 0:
-            source = str(attachment)
-            name = str(attachment.relative_to(dir))
-
-            # compress files larger than 1Mb, they're hardly readable in a browser
-            if attachment.stat().st_size > 1024 * 1024:
-                source = f"{attachment}.tar.gz"
-                with tarfile.open(source, "w:gz") as tar:
-                    tar.add(attachment, arcname=attachment.name)
-                name = f"{name}.tar.gz"
-
-            if source.endswith(".tar.gz"):
-                attachment_type = "application/gzip"
-                extension = "tar.gz"
-            elif source.endswith(".svg"):
-                attachment_type = "image/svg+xml"
-                extension = "svg"
-            elif source.endswith(".html"):
-                attachment_type = "text/html"
-                extension = "html"
-            else:
-                attachment_type = "text/plain"
-                extension = attachment.suffix.removeprefix(".")
-
-            allure.attach.file(source, name, attachment_type, extension)
+    """Attach all non-empty files from `dir` that matches `is_attachment_name` to Allure report"""
+
+    for attachment in _iter_files(str(dir)):
+        name_cf = attachment.name.casefold()
+        if not is_attachment_name(name_cf):
+            continue
+
+        size = attachment.stat(follow_symlinks=False).st_size
+        if size == 0:
+            continue
+
+        source = attachment.path
+        name = os.path.relpath(attachment.path, dir)
+
+        # compress files larger than 1Mb, they're hardly readable in a browser.
+        # The fastest compression level is used: these are mostly logs, which
+        # compress well anyway and are rarely downloaded.
+        if size > 1024 * 1024:
+            source = f"{attachment.path}.zip"
+            with zipfile.ZipFile(source, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+                zf.write(attachment.path, arcname=attachment.name)
+            name = f"{name}.zip"
+
+        if source.endswith(".zip"):
+            attachment_type = "application/zip"
+            extension = "zip"
+        elif name_cf.endswith(".svg"):
+            attachment_type = "image/svg+xml"
+            extension = "svg"
+        elif name_cf.endswith(".html"):
+            attachment_type = "text/html"
+            extension = "html"
+        else:
+            attachment_type = "text/plain"
+            extension = os.path.splitext(name_cf)[1].removeprefix(".")
+
+        allure.attach.file(source, name, attachment_type, extension)
@@ -1,13 +1,10 @@
+import concurrent.futures
+
 from fixtures.log_helper import log
 from fixtures.neon_fixtures import NeonEnvBuilder, wait_until
 from fixtures.types import TenantId, TimelineId
 
 
-def get_only_element(l):  # noqa: E741
-    assert len(l) == 1
-    return l[0]
-
-
 # Test that gc and compaction tenant tasks start and stop correctly
 def test_tenant_tasks(neon_env_builder: NeonEnvBuilder):
     # The gc and compaction loops don't bother to watch for tenant state
@@ -23,22 +20,39 @@ def test_tenant_tasks(neon_env_builder: NeonEnvBuilder):
 
     def get_state(tenant):
         all_states = client.tenant_list()
-        matching = [t for t in all_states if TenantId(t["id"]) == tenant]
-        return get_only_element(matching)["state"]
+        tenant_str = str(tenant)
+        found = next((t for t in all_states if t["id"] == tenant_str), None)
+        assert found is not None
+        return found["state"]
 
-    def get_metric_value(name):
+    def get_metric_values(names):
+        """Get values of all `names` metrics from a single /metrics snapshot"""
         metrics = client.get_metrics()
-        relevant = [line for line in metrics.splitlines() if line.startswith(name)]
-        if len(relevant) == 0:
-            return 0
-        line = get_only_element(relevant)
-        value = line.lstrip(name).strip()
-        return int(value)
+        values = {name: 0 for name in names}
+        pending = set(names)
+        for line in metrics.splitlines():
+            for name in pending:
+                if line.startswith(name):
+                    # lstrip() would treat `name` as a set of characters, so cut the prefix instead
+                    values[name] = int(line[len(name) :].strip())
+                    # only the first matching line counts
+                    pending.remove(name)
+                    break
+            if not pending:
+                break
+        return values
+
+    def get_metric_value(name):
+        return get_metric_values([name])[name]
 
     def delete_all_timelines(tenant: TenantId):
-        timelines = [TimelineId(t["timeline_id"]) for t in client.timeline_list(tenant)]
-        for t in timelines:
-            client.timeline_delete(tenant, t)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [
+                executor.submit(client.timeline_delete, tenant, TimelineId(t["timeline_id"]))
+                for t in client.timeline_list(tenant)
+            ]
+            for future in futures:
+                future.result()
 
     def assert_active_without_jobs(tenant):
         assert get_state(tenant) == {"Active": {"background_jobs_running": False}}
@@ -66,9 +80,13 @@ def test_tenant_tasks(neon_env_builder: NeonEnvBuilder):
     client.tenant_detach(env.initial_tenant)
 
     def assert_tasks_finish():
-        tasks_started = get_metric_value('pageserver_tenant_task_events{event="start"}')
-        tasks_ended = get_metric_value('pageserver_tenant_task_events{event="stop"}')
-        tasks_panicked = get_metric_value('pageserver_tenant_task_events{event="panic"}')
+        names = (
+            'pageserver_tenant_task_events{event="start"}',
+            'pageserver_tenant_task_events{event="stop"}',
+            'pageserver_tenant_task_events{event="panic"}',
+        )
+        values = get_metric_values(names)
+        tasks_started, tasks_ended, tasks_panicked = (values[n] for n in names)
         log.info(f"started {tasks_started}, ended {tasks_ended}, panicked {tasks_panicked}")
         assert tasks_started == tasks_ended
         assert tasks_panicked == 0